@@ -12,9 +12,39 @@ from sys import exit
 import utils
 import progressbar
 import sys
+import time
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 
 CHUNK_SIZE = 2048
 
+# Boards answer with a packed boolean, which is a single fixed byte
+MSGPACK_TRUE = msgpack.packb(True)
+
+
+class RateLimitedProgressBar:
+    """
+    Progress bar which redraws at most once every min_interval seconds.
+
+    Redrawing the bar for every chunk writes to the terminal thousands of times
+    for large binaries, so intermediate updates are dropped.
+    """
+    def __init__(self, maxval, min_interval=0.05):
+        self.pbar = progressbar.ProgressBar(maxval=maxval).start()
+        self.min_interval = min_interval
+        self.last_update = None
+
+    def update(self, value):
+        now = time.monotonic()
+
+        if self.last_update is None or \
+           now - self.last_update >= self.min_interval:
+            self.pbar.update(value)
+            self.last_update = now
+
+    def finish(self):
+        self.pbar.finish()
+
 
 def parse_commandline_args(args=None):
     """
@@ -48,26 +78,47 @@ def parse_commandline_args(args=None):
     return parser.parse_args(args)
 
 
+def read_binary(input_file):
+    """
+    Reads the whole binary from the given file.
+
+    The file is memory-mapped if possible, so that it is not copied in memory.
+    Otherwise it is read in a single call.
+    """
+    try:
+        return mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Not a real file, an empty one or mmap is not supported
+        return input_file.read()
+
+
 def flash_binary(fdesc, binary, base_address, device_class, destinations,
-                 page_size=2048):
+                 page_size=2048, encode_workers=1):
     """
     Writes a full binary to the flash using the given file descriptor.
 
     It also takes the binary image, the base address and the device class as
-    parameters.
-    """
+    parameters. The CRC stored in the config is computed chunk by chunk while
+    writing, so the binary is not walked a second time.
 
+    Returns the CRC of the binary.
+
+    Write commands are encoded by encode_workers threads while the previous
+    chunk is being written. If it is zero, they are encoded in the loop.
+    """
     print("Erasing pages...")
-    pbar = progressbar.ProgressBar(maxval=len(binary)).start()
+    pbar = RateLimitedProgressBar(maxval=len(binary))
+
+    encode_erase_flash_page = \
+        commands.encode_erase_flash_page_builder(device_class)
 
     # First erase all pages
     for offset in range(0, len(binary), page_size):
-        erase_command = commands.encode_erase_flash_page(base_address + offset,
-                                                         device_class)
+        erase_command = encode_erase_flash_page(base_address + offset)
         res = utils.write_command_retry(fdesc, erase_command, destinations)
 
         failed_boards = [str(id) for id, success in res.items()
-                         if not msgpack.unpackb(success)]
+                         if success != MSGPACK_TRUE]
 
         if failed_boards:
             msg = ", ".join(failed_boards)
@@ -80,68 +131,157 @@ def flash_binary(fdesc, binary, base_address, device_class, destinations,
     pbar.finish()
 
     print("Writing pages...")
-    pbar = progressbar.ProgressBar(maxval=len(binary)).start()
+    pbar = RateLimitedProgressBar(maxval=len(binary))
 
-    # Then write all pages in chunks
-    for offset, chunk in enumerate(page.slice_into_pages(binary, CHUNK_SIZE)):
-        offset *= CHUNK_SIZE
-        command = commands.encode_write_flash(chunk,
-                                              base_address + offset,
-                                              device_class)
+    encode_write_flash = commands.encode_write_flash_builder(device_class)
+    chunk_size = CHUNK_SIZE
 
-        res = utils.write_command_retry(fdesc, command, destinations)
-        failed_boards = [str(id) for id, success in res.items()
-                         if not msgpack.unpackb(success)]
+    def encode_chunk(item):
+        offset, chunk = item
+        return offset, chunk, encode_write_flash(chunk, base_address + offset)
 
-        if failed_boards:
-            msg = ", ".join(failed_boards)
-            msg = "Boards {} failed during page write, aborting...".format(msg)
-            logging.critical(msg)
-            sys.exit(2)
+    chunks = zip(range(0, len(binary), chunk_size),
+                 page.slice_into_pages(binary, chunk_size))
+    executor = None
+    if encode_workers:
+        executor = ThreadPoolExecutor(max_workers=encode_workers)
+
+    crc = 0
+
+    # Then write all pages in chunks
+    try:
+        for offset, chunk, command in utils.prefetch(encode_chunk, chunks,
+                                                     executor):
+            res = utils.write_command_retry(fdesc, command, destinations)
+            failed_boards = [str(id) for id, success in res.items()
+                             if success != MSGPACK_TRUE]
+
+            if failed_boards:
+                msg = ", ".join(failed_boards)
+                msg = "Boards {} failed during page write, aborting..." \
+                      .format(msg)
+                logging.critical(msg)
+                sys.exit(2)
+
+            crc = crc32(chunk, crc)
+            pbar.update(offset)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-        pbar.update(offset)
     pbar.finish()
 
     # Finally update application CRC and size in config
     config = dict()
     config['application_size'] = len(binary)
-    config['application_crc'] = crc32(binary)
+    config['application_crc'] = crc
     utils.config_update_and_save(fdesc, config, destinations)
 
+    return crc
+
 
-def check_binary(fdesc, binary, base_address, destinations):
+def decode_crc(answer):
+    """
+    Decodes the CRC a board answered.
+
+    Returns None if the answer is malformed, so that the board is considered
+    failing instead of aborting the verification of all boards.
+    """
+    try:
+        return msgpack.unpackb(answer)
+    except ValueError:
+        return None
+
+
+def check_binary(fdesc, binary, base_address, destinations,
+                 expected_crc=None, timeout=10):
     """
     Check that the binary was correctly written to all destinations.
 
-    Returns a list of all nodes which are passing the test.
+    Boards which did not answer after timeout seconds are considered failing.
+
+    Returns a tuple of two sets: the nodes which are passing the test and the
+    nodes which answered with a wrong CRC. Nodes which did not answer are in
+    neither of them.
     """
-    valid_nodes = []
+    valid_nodes = set()
+    mismatched_nodes = set()
 
-    expected_crc = crc32(binary)
+    if expected_crc is None:
+        expected_crc = crc32(binary)
 
     command = commands.encode_crc_region(base_address, len(binary))
     utils.write_command(fdesc, command, destinations)
 
     reader = utils.read_can_datagrams(fdesc)
 
-    boards_checked = 0
+    pending = set(destinations)
+    deadline = time.monotonic() + timeout
 
-    while boards_checked < len(destinations):
-        dt = next(reader)
+    while pending and time.monotonic() < deadline:
+        dt = next(reader, None)
 
         if dt is None:
             continue
 
         answer, _, src = dt
 
-        crc = msgpack.unpackb(answer)
+        # Ignore retransmitted answers and unexpected boards
+        if src not in pending:
+            continue
+
+        pending.remove(src)
 
-        if crc == expected_crc:
-            valid_nodes.append(src)
+        if decode_crc(answer) == expected_crc:
+            valid_nodes.add(src)
+        else:
+            mismatched_nodes.add(src)
 
-        boards_checked += 1
+    return valid_nodes, mismatched_nodes
 
-    return valid_nodes
+
+def page_crcs(binary, base_address, page_size=2048):
+    """
+    Yields an (address, length, crc) tuple for each flash page covered by the
+    binary.
+
+    The CRCs are computed lazily, so pages after the last one checked are never
+    read.
+    """
+    pages = page.slice_into_pages(binary, page_size)
+
+    for offset, chunk in zip(range(0, len(binary), page_size), pages):
+        yield base_address + offset, len(chunk), crc32(chunk)
+
+
+def find_corrupted_pages(fdesc, binary, base_address, destinations,
+                         page_size=2048):
+    """
+    Compares the CRC of each flash page of the given boards with the binary.
+
+    A board is not checked any further once a corrupted page is found on it.
+
+    Returns a dictionary mapping each failing board to the address of its first
+    corrupted page.
+    """
+    corrupted_pages = dict()
+    remaining = list(destinations)
+
+    for address, length, expected_crc in page_crcs(binary, base_address,
+                                                   page_size):
+        if not remaining:
+            break
+
+        command = commands.encode_crc_region(address, length)
+        res = utils.write_command_retry(fdesc, command, remaining)
+
+        for board, answer in res.items():
+            if decode_crc(answer) != expected_crc:
+                corrupted_pages[board] = address
+
+        remaining = [b for b in remaining if b not in corrupted_pages]
+
+    return corrupted_pages
 
 
 def run_application(fdesc, destinations):
@@ -162,21 +302,29 @@ def verification_failed(failed_nodes):
     exit(1)
 
 
-def check_online_boards(fdesc, boards):
+def check_online_boards(fdesc, boards, timeout=5):
     """
     Returns a set containing the online boards.
+
+    Stops waiting as soon as all boards answered, on a read timeout or after
+    timeout seconds.
     """
     online_boards = set()
+    expected_boards = set(boards)
+    deadline = time.monotonic() + timeout
 
     utils.write_command(fdesc, commands.encode_ping(), boards)
     reader = utils.read_can_datagrams(fdesc)
 
     for dt in reader:
-        if dt is None:
+        if dt is None or time.monotonic() > deadline:
             break
         _, _, src = dt
         online_boards.add(src)
 
+        if online_boards >= expected_boards:
+            break
+
     return online_boards
 
 
@@ -186,31 +334,49 @@ def main():
     """
     args = parse_commandline_args()
     with open(args.binary_file, 'rb') as input_file:
-        binary = input_file.read()
+        binary = read_binary(input_file)
 
+    ids = frozenset(args.ids)
     serial_port = utils.open_connection(args)
 
     online_boards = check_online_boards(serial_port, args.ids)
 
-    if online_boards != set(args.ids):
-        offline_boards = [str(i) for i in set(args.ids) - online_boards]
+    if online_boards != ids:
+        offline_boards = [str(i) for i in ids - online_boards]
         print("Boards {} are offline, aborting..."
               .format(", ".join(offline_boards)))
         exit(2)
 
     print("Flashing firmware (size: {} bytes)".format(len(binary)))
-    flash_binary(serial_port, binary, args.base_address, args.device_class,
-                 args.ids)
+    crc = flash_binary(serial_port, binary, args.base_address,
+                       args.device_class, args.ids)
 
     print("Verifying firmware...")
-    valid_nodes_set = set(check_binary(serial_port, binary,
-                                       args.base_address, args.ids))
-    nodes_set = set(args.ids)
+    valid_nodes, mismatched_nodes = check_binary(serial_port, binary,
+                                                 args.base_address, args.ids,
+                                                 expected_crc=crc)
 
-    if valid_nodes_set == nodes_set:
+    if valid_nodes == ids:
         print("OK")
     else:
-        verification_failed(nodes_set - valid_nodes_set)
+        failed_nodes = ids - valid_nodes
+        corrupted_pages = dict()
+
+        # Locate the faulty pages to help diagnosing the failure. Boards which
+        # did not answer at all are left out, as they would only time out.
+        if mismatched_nodes:
+            try:
+                corrupted_pages = find_corrupted_pages(serial_port, binary,
+                                                       args.base_address,
+                                                       mismatched_nodes)
+            except IOError:
+                pass
+
+        for node, address in sorted(corrupted_pages.items()):
+            print("Node {} has a corrupted page at 0x{:x}"
+                  .format(node, address))
+
+        verification_failed(failed_nodes)
 
     if args.run:
         run_application(serial_port, args.ids)
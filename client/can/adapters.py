@@ -10,9 +10,11 @@ class SocketCANConnection:
     CAN_FRAME_SIZE = struct.calcsize(CAN_FRAME_FMT)
 
 
-    def __init__(self, interface):
+    def __init__(self, interface, timeout=1):
         """
         Initiates a CAN connection on the given interface (e.g. 'can0').
+
+        Receiving a frame gives up after timeout seconds.
         """
         # Creates a raw CAN connection and binds it to the given interface.
         self.socket = socket.socket(socket.AF_CAN,
@@ -20,6 +22,7 @@ class SocketCANConnection:
                                     socket.CAN_RAW)
 
         self.socket.bind((interface, ))
+        self.socket.settimeout(timeout)
 
     def send_frame(self, frame):
         data = frame.data.ljust(8, b'\x00')
@@ -31,7 +34,11 @@ class SocketCANConnection:
         self.socket.send(data)
 
     def receive_frame(self):
-        frame, _ = self.socket.recvfrom(self.CAN_FRAME_SIZE)
+        try:
+            frame, _ = self.socket.recvfrom(self.CAN_FRAME_SIZE)
+        except socket.timeout:
+            return None
+
         can_id, can_dlc, data = struct.unpack(self.CAN_FRAME_FMT, frame)
 
         return can.Frame(id=can_id, data=data[:can_dlc])
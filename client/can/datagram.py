@@ -84,13 +84,15 @@ def datagram_to_frames(datagram, source):
     Transforms a raw datagram into CAN frames.
     """
     start_bit = START_OF_DATAGRAM_MASK
+    offset = 0
 
-    while len(datagram) > 8:
-        data, datagram = datagram[:8], datagram[8:]
-
-        yield Frame(id=start_bit + source, data=data)
+    # Index into the datagram instead of slicing off its tail, which would
+    # copy the remaining data for every frame.
+    while len(datagram) - offset > 8:
+        yield Frame(id=start_bit + source, data=datagram[offset:offset + 8])
 
+        offset += 8
         start_bit = 0
 
-    yield Frame(id=start_bit + source, data=datagram)
+    yield Frame(id=start_bit + source, data=datagram[offset:])
 
@@ -33,12 +33,50 @@ def encode_erase_flash_page(address, device_class):
     """
     return encode_command(CommandType.Erase, address, device_class)
 
+def encode_erase_flash_page_builder(device_class):
+    """
+    Returns a function encoding erase commands for the given device class.
+
+    The returned function takes the page address and gives the same result as
+    encode_erase_flash_page, but the parts of the command which do not depend
+    on it are only encoded once.
+    """
+    p = Packer(use_bin_type=True)
+    header = p.pack(COMMAND_SET_VERSION) + p.pack(CommandType.Erase)
+    header += p.pack_array_header(2)
+    device_class = p.pack(device_class)
+
+    def encode(address):
+        p = Packer(use_bin_type=True)
+        return header + p.pack(address) + device_class
+
+    return encode
+
 def encode_write_flash(data, address, device_class):
     """
     Encodes the command to write the given data at the given address in a
     messagepack byte object.
     """
-    return encode_command(CommandType.Write, address, device_class, data)
+    return encode_command(CommandType.Write, address, device_class, bytes(data))
+
+def encode_write_flash_builder(device_class):
+    """
+    Returns a function encoding write commands for the given device class.
+
+    The returned function takes the data and the address and gives the same
+    result as encode_write_flash, but the parts of the command which do not
+    depend on them are only encoded once.
+    """
+    p = Packer(use_bin_type=True)
+    header = p.pack(COMMAND_SET_VERSION) + p.pack(CommandType.Write)
+    header += p.pack_array_header(3)
+    device_class = p.pack(device_class)
+
+    def encode(data, address):
+        p = Packer(use_bin_type=True)
+        return header + p.pack(address) + device_class + p.pack(bytes(data))
+
+    return encode
 
 def encode_read_flash(aderess, length):
     """
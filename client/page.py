@@ -1,8 +1,10 @@
 def slice_into_pages(data, page_size):
     """
     Slices data into chunks that are at max page_size big.
+
+    The chunks are memoryviews on data, which avoids copying the remaining
+    data each time a chunk is yielded.
     """
-    while len(data) > page_size:
-        yield data[:page_size]
-        data = data[page_size:]
-    yield data
+    view = memoryview(data)
+    for offset in range(0, len(view), page_size):
+        yield view[offset:offset + page_size]
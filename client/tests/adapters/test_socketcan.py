@@ -1,8 +1,5 @@
 from unittest import TestCase
-try:
-    from unittest.mock import *
-except ImportError:
-    from mock import *
+from unittest.mock import patch, Mock
 
 
 import socket
@@ -32,6 +29,14 @@ class SocketCANTestCase(TestCase):
 
         socket_create.return_value.bind.assert_any_call(('vcan0', ))
 
+    def test_socket_has_timeout(self, socket_create):
+        """
+        Checks that receiving frames does not block forever.
+        """
+        SocketCANConnection('vcan0', timeout=2)
+
+        socket_create.return_value.settimeout.assert_any_call(2)
+
     def test_can_send_frame(self, socket_create):
         s = SocketCANConnection('vcan0')
         s.socket = Mock()
@@ -65,3 +70,13 @@ class SocketCANTestCase(TestCase):
 
         self.assertEqual(expected_frame, actual_frame)
 
+
+    def test_receive_frame_timeout(self, socket_create):
+        """
+        Checks that a timeout is reported as None, like the CAN dongle does.
+        """
+        s = SocketCANConnection('vcan0')
+        s.socket = Mock()
+        s.socket.recvfrom.side_effect = socket.timeout
+
+        self.assertIsNone(s.receive_frame())
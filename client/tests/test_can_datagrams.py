@@ -3,10 +3,7 @@ from struct import unpack_from, pack
 from zlib import crc32
 from can import *
 
-try:
-    import unittest.mock as mock
-except ImportError:
-    import mock
+import unittest.mock as mock
 
 class CanDatagramTestCase(unittest.TestCase):
     data = 'hello, world'.encode('ascii')
@@ -1,9 +1,6 @@
 import unittest
 
-try:
-    from unittest.mock import *
-except ImportError:
-    from mock import *
+from unittest.mock import patch
 
 import sys
 import bootloader_change_id
@@ -80,6 +80,26 @@ class WriteCommandTestCase(unittest.TestCase):
         # Finally data
         self.assertEqual(raw_packet[-1], 12)
 
+class WriteCommandBuilderTestCase(unittest.TestCase):
+    """
+    Checks that the write command builder gives the same result as
+    encode_write_flash.
+    """
+    def test_same_as_encode_write_flash(self):
+        encode = encode_write_flash_builder("dummy")
+
+        for address in [0, 0x10, 0x1000, 0xdeadbeef]:
+            data = bytes(range(20))
+            self.assertEqual(encode_write_flash(data, address, "dummy"),
+                             encode(data, address))
+
+    def test_accepts_memoryview(self):
+        encode = encode_write_flash_builder("dummy")
+        data = bytes(range(20))
+
+        self.assertEqual(encode_write_flash(data, 0x1000, "dummy"),
+                         encode(memoryview(data), 0x1000))
+
 class EraseCommandTestCase(unittest.TestCase):
     """
     Tests for the erase flash page command.
@@ -112,6 +132,18 @@ class EraseCommandTestCase(unittest.TestCase):
         """
         self.assertEqual(self.command[1][1].decode('ascii'), "LivewareProblem")
 
+class EraseCommandBuilderTestCase(unittest.TestCase):
+    """
+    Checks that the erase command builder gives the same result as
+    encode_erase_flash_page.
+    """
+    def test_same_as_encode_erase_flash_page(self):
+        encode = encode_erase_flash_page_builder("LivewareProblem")
+
+        for address in [0, 0x10, 0x1000, 0xfa1afe1]:
+            self.assertEqual(encode_erase_flash_page(address, "LivewareProblem"),
+                             encode(address))
+
 class JumpToApplicationMainTestCase(unittest.TestCase):
     """
     Tests for the jump to application main command.
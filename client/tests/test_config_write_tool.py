@@ -1,9 +1,6 @@
 import unittest
 
-try:
-    from unittest.mock import *
-except ImportError:
-    from mock import *
+from unittest.mock import patch
 
 import bootloader_write_config
 from io import StringIO
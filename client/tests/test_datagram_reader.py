@@ -1,8 +1,5 @@
 import unittest
-try:
-    from unittest.mock import Mock
-except ImportError:
-    from mock import Mock
+from unittest.mock import Mock
 
 import can
 from utils import read_can_datagrams
@@ -1,9 +1,6 @@
 import unittest
 
-try:
-    from unittest.mock import *
-except ImportError:
-    from mock import *
+from unittest.mock import patch, Mock, call, ANY
 
 from zlib import crc32
 
@@ -13,6 +10,9 @@ from utils import *
 import msgpack
 
 from io import BytesIO
+import tempfile
+from itertools import repeat
+import mmap
 
 import sys
 
@@ -74,6 +74,19 @@ class FlashBinaryTestCase(unittest.TestCase):
         write_command = encode_write_flash(bytes([0] * 2048), address + 2048, device_class)
         write.assert_any_call(self.fd, write_command, destinations)
 
+    def test_write_without_encode_workers(self, write):
+        """
+        Checks that chunks are still written when encoding in the loop.
+        """
+        data = bytes([0] * 4096)
+        address = 0x1000
+        destinations = [1]
+
+        flash_binary(self.fd, data, address, "dummy", [1], encode_workers=0)
+
+        write_command = encode_write_flash(bytes([0] * 2048), address + 2048, "dummy")
+        write.assert_any_call(self.fd, write_command, destinations)
+
     def test_erase_multiple_pages(self, write):
         """
         Checks that all pages are erased before writing data to them.
@@ -102,6 +115,52 @@ class FlashBinaryTestCase(unittest.TestCase):
         expected_config = {'application_size': 10, 'application_crc': crc32(data)}
         conf.assert_any_call(self.fd, expected_config, dst)
 
+    @patch('utils.config_update_and_save')
+    def test_crc_of_many_chunks(self, conf, write):
+        """
+        Tests that the CRC computed chunk by chunk covers the whole binary.
+        """
+        data = bytes(range(256)) * 20
+        dst = [1]
+
+        flash_binary(self.fd, data, 0x1000, '', dst)
+
+        expected_config = {'application_size': len(data),
+                           'application_crc': crc32(data)}
+        conf.assert_any_call(self.fd, expected_config, dst)
+
+    def test_returns_crc(self, write):
+        """
+        Checks that the CRC of the written binary is returned.
+        """
+        data = bytes(range(256)) * 20
+
+        crc = flash_binary(self.fd, data, 0x1000, '', [1])
+
+        self.assertEqual(crc32(data), crc)
+
+    @patch('utils.read_can_datagrams')
+    @patch('utils.write_command')
+    def test_binary_is_crced_once(self, write_command, read_datagram, write):
+        """
+        Checks that reading, flashing and verifying the binary only computes
+        its CRC once.
+        """
+        data = bytes(range(256)) * 20
+
+        with patch('bootloader_flash.crc32', wraps=crc32) as crc_function:
+            binary = read_binary(BytesIO(data))
+            crc = flash_binary(self.fd, binary, 0x1000, '', [1])
+
+            read_datagram.return_value = iter([(msgpack.packb(crc), [0], 1)])
+            valid_nodes, _ = check_binary(self.fd, binary, 0x1000, [1],
+                                       expected_crc=crc)
+
+        self.assertEqual(set([1]), valid_nodes)
+
+        crced_bytes = sum(len(args[0]) for args, _ in crc_function.call_args_list)
+        self.assertEqual(len(data), crced_bytes)
+
     @patch('logging.critical')
     def test_bad_board_page_erase(self, c, write):
         """
@@ -172,9 +231,30 @@ class ConfigTestCase(unittest.TestCase):
         read_datagram.return_value = iter(side_effect)
 
 
-        valid_nodes = check_binary(self.fd, binary, 0x1000, [1, 2])
+        valid_nodes, mismatched_nodes = check_binary(self.fd, binary, 0x1000, [1, 2])
 
-        self.assertEqual([1], valid_nodes)
+        self.assertEqual(set([1]), valid_nodes)
+        self.assertEqual(set([2]), mismatched_nodes)
+
+    @patch('utils.read_can_datagrams')
+    @patch('utils.write_command')
+    def test_answers_are_decoded_separately(self, write, read_datagram):
+        """
+        Checks that a malformed answer from one board makes only this board
+        fail, without leaking into the answer of another board.
+        """
+        binary = bytes([0] * 10)
+        crc = crc32(binary)
+
+        side_effect  = [(msgpack.packb(0xdead) + bytes([0xcd]), [0], 2)]
+        side_effect += [(msgpack.packb(crc), [0], 1)]
+
+        read_datagram.return_value = iter(side_effect)
+
+        valid_nodes, mismatched_nodes = check_binary(self.fd, binary, 0x1000, [1, 2])
+
+        self.assertEqual(set([1]), valid_nodes)
+        self.assertEqual(set([2]), mismatched_nodes)
 
     @patch('utils.read_can_datagrams')
     @patch('utils.write_command')
@@ -192,9 +272,211 @@ class ConfigTestCase(unittest.TestCase):
 
         read_datagram.return_value = iter(side_effect)
 
-        valid_nodes = check_binary(self.fd, binary, 0x1000, [1, 2])
+        valid_nodes, mismatched_nodes = check_binary(self.fd, binary, 0x1000, [1, 2])
+
+        self.assertEqual(set([1]), valid_nodes)
+        self.assertEqual(set([2]), mismatched_nodes)
+
+    @patch('utils.read_can_datagrams')
+    @patch('utils.write_command')
+    def test_verify_ignores_duplicate_answers(self, write, read_datagram):
+        """
+        Checks that a board answering twice does not hide another board's
+        answer.
+        """
+        binary = bytes([0] * 10)
+        crc = crc32(binary)
+
+        side_effect  = [(msgpack.packb(0xdead), [0], 2)]
+        side_effect += [(msgpack.packb(0xdead), [0], 2)] # retransmission
+        side_effect += [(msgpack.packb(crc), [0], 1)]
+
+        read_datagram.return_value = iter(side_effect)
+
+        valid_nodes, mismatched_nodes = check_binary(self.fd, binary, 0x1000, [1, 2])
+
+        self.assertEqual(set([1]), valid_nodes)
+        self.assertEqual(set([2]), mismatched_nodes)
+
+    @patch('time.monotonic')
+    @patch('utils.read_can_datagrams')
+    @patch('utils.write_command')
+    def test_verify_gives_up_after_timeout(self, write, read_datagram,
+                                           monotonic):
+        """
+        Checks that a board which never answers is reported as failing instead
+        of blocking forever.
+        """
+        binary = bytes([0] * 10)
+        crc = crc32(binary)
+
+        monotonic.side_effect = [0, 1, 2, 11]
+        read_datagram.return_value = iter([(msgpack.packb(crc), [0], 1)])
+
+        valid_nodes, mismatched_nodes = check_binary(self.fd, binary, 0x1000, [1, 2],
+                                                     timeout=10)
+
+        self.assertEqual(set([1]), valid_nodes)
+        self.assertEqual(set(), mismatched_nodes)
+
+@patch('time.monotonic')
+@patch('progressbar.ProgressBar')
+class RateLimitedProgressBarTestCase(unittest.TestCase):
+    def test_first_update_is_drawn(self, pbar, monotonic):
+        monotonic.return_value = 10.
+        bar = RateLimitedProgressBar(maxval=100)
+        bar.update(1)
+
+        pbar.return_value.start.return_value.update.assert_any_call(1)
+
+    def test_fast_updates_are_dropped(self, pbar, monotonic):
+        monotonic.side_effect = [10., 10.01, 10.1]
+        bar = RateLimitedProgressBar(maxval=100, min_interval=0.05)
+        inner = pbar.return_value.start.return_value
+
+        for value in [1, 2, 3]:
+            bar.update(value)
 
-        self.assertEqual([1], valid_nodes)
+        inner.update.assert_has_calls([call(1), call(3)])
+        self.assertEqual(2, inner.update.call_count)
+
+    def test_finish(self, pbar, monotonic):
+        bar = RateLimitedProgressBar(maxval=100)
+        bar.finish()
+
+        pbar.return_value.start.return_value.finish.assert_any_call()
+
+@patch('utils.read_can_datagrams')
+@patch('utils.write_command')
+class OnlineBoardsTestCase(unittest.TestCase):
+    fd = 'port'
+
+    def test_stops_when_all_boards_answered(self, write, read_datagram):
+        """
+        Checks that we don't wait for a timeout once every board answered.
+        """
+        answers = [(bytes(), [0], 1), (bytes(), [0], 2)]
+        reader = iter(answers + [(bytes(), [0], 3)])
+        read_datagram.return_value = reader
+
+        online = check_online_boards(self.fd, [1, 2])
+
+        self.assertEqual(set([1, 2]), online)
+
+        # The third answer was never read
+        self.assertEqual((bytes(), [0], 3), next(reader))
+
+    def test_stops_on_timeout(self, write, read_datagram):
+        read_datagram.return_value = iter([(bytes(), [0], 1), None])
+
+        online = check_online_boards(self.fd, [1, 2])
+
+        self.assertEqual(set([1]), online)
+
+    @patch('time.monotonic')
+    def test_stops_after_deadline(self, monotonic, write, read_datagram):
+        """
+        Checks that a bus flooded with answers does not block us forever.
+        """
+        monotonic.side_effect = [0, 1, 10]
+        read_datagram.return_value = repeat((bytes(), [0], 1))
+
+        online = check_online_boards(self.fd, [1, 2], timeout=5)
+
+        self.assertEqual(set([1]), online)
+
+class CorruptedPagesTestCase(unittest.TestCase):
+    fd = 'port'
+
+    def test_page_crcs(self):
+        """
+        Checks that the CRC of each page is computed, including a partial last
+        page.
+        """
+        binary = bytes(range(10))
+
+        pages = list(page_crcs(binary, 0x1000, page_size=4))
+
+        expected = [(0x1000, 4, crc32(binary[0:4])),
+                    (0x1004, 4, crc32(binary[4:8])),
+                    (0x1008, 2, crc32(binary[8:10]))]
+        self.assertEqual(expected, pages)
+
+    @patch('utils.write_command_retry')
+    def test_find_corrupted_page(self, write):
+        """
+        Checks that the first corrupted page of each board is found and that a
+        failing board is not checked any further.
+        """
+        binary = bytes(range(12))
+        good = [msgpack.packb(crc32(binary[i:i+4])) for i in range(0, 12, 4)]
+        bad = msgpack.packb(0xdead)
+
+        write.side_effect = [{1: good[0], 2: good[0]},
+                             {1: bad, 2: good[1]},
+                             {2: bad}]
+
+        res = find_corrupted_pages(self.fd, binary, 0x1000, [1, 2], page_size=4)
+
+        self.assertEqual({1: 0x1004, 2: 0x1008}, res)
+        write.assert_any_call(self.fd, encode_crc_region(0x1008, 4), [2])
+
+    @patch('utils.write_command_retry')
+    def test_malformed_answer_is_corrupted_page(self, write):
+        """
+        Checks that a board answering a malformed CRC is reported instead of
+        aborting the search.
+        """
+        binary = bytes(range(4))
+        write.return_value = {1: bytes([0xc1]), 2: msgpack.packb(crc32(binary))}
+
+        res = find_corrupted_pages(self.fd, binary, 0x1000, [1, 2])
+
+        self.assertEqual({1: 0x1000}, res)
+
+    @patch('utils.write_command_retry')
+    def test_no_corrupted_page(self, write):
+        binary = bytes(range(4))
+        write.return_value = {1: msgpack.packb(crc32(binary))}
+
+        res = find_corrupted_pages(self.fd, binary, 0x1000, [1])
+
+        self.assertEqual({}, res)
+
+class ReadBinaryTestCase(unittest.TestCase):
+    def test_read_binary(self):
+        """
+        Checks that a file without descriptor is read.
+        """
+        data = bytes(range(100))
+
+        binary = read_binary(BytesIO(data))
+
+        self.assertEqual(data, binary)
+
+    def test_read_binary_mmap(self):
+        """
+        Checks that a real file is memory-mapped.
+        """
+        data = bytes(range(100))
+
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            binary = read_binary(f)
+
+            self.assertIsInstance(binary, mmap.mmap)
+            self.assertEqual(data, binary[:])
+            binary.close()
+
+    def test_read_empty_binary(self):
+        """
+        Checks that an empty file, which cannot be memory-mapped, is read.
+        """
+        with tempfile.TemporaryFile() as f:
+            binary = read_binary(f)
+
+        self.assertEqual(b"", binary)
 
 class RunApplicationTestCase(unittest.TestCase):
     fd = 'port'
@@ -231,6 +513,8 @@ class MainTestCase(unittest.TestCase):
         self.flash = mock('bootloader_flash.flash_binary')
         self.check = mock('bootloader_flash.check_binary')
         self.run = mock('bootloader_flash.run_application')
+        self.find_corrupted = mock('bootloader_flash.find_corrupted_pages')
+        self.find_corrupted.return_value = dict()
 
         self.check_online_boards = mock('bootloader_flash.check_online_boards')
         self.check_online_boards.side_effect = lambda f, b: set([1, 2, 3])
@@ -240,7 +524,7 @@ class MainTestCase(unittest.TestCase):
         self.open.return_value = BytesIO(self.binary_data)
 
         # Flash checking results
-        self.check.return_value = [1, 2, 3] # all boards are ok
+        self.check.return_value = (set([1, 2, 3]), set()) # all boards are ok
 
         # Populate command line arguments
         sys.argv = "test.py -b test.bin -a 0x1000 -p /dev/ttyUSB0 -c dummy 1 2 3".split()
@@ -282,18 +566,57 @@ class MainTestCase(unittest.TestCase):
         Checks that the flash is verified.
         """
         main()
-        self.check.assert_any_call(self.conn, self.binary_data, 0x1000, [1,2,3])
+        self.check.assert_any_call(self.conn, self.binary_data, 0x1000, [1,2,3],
+                                   expected_crc=self.flash.return_value)
 
 
     def test_check_failed(self):
         """
         Checks that the program behaves correctly when verification fails.
         """
-        self.check.return_value = [1]
+        self.check.return_value = (set([1]), set([2, 3]))
         with patch('bootloader_flash.verification_failed') as failed:
             main()
             failed.assert_any_call(set((2,3)))
 
+    def test_corrupted_pages_are_reported(self):
+        """
+        Checks that the corrupted pages of failing boards are printed.
+        """
+        self.check.return_value = (set([1, 3]), set([2]))
+        self.find_corrupted.return_value = {2: 0x1800}
+
+        with patch('bootloader_flash.verification_failed'):
+            main()
+
+        self.find_corrupted.assert_any_call(self.conn, self.binary_data,
+                                            0x1000, set([2]))
+        self.print.assert_any_call('Node 2 has a corrupted page at 0x1800')
+
+    def test_silent_board_does_not_hide_corrupted_pages(self):
+        """
+        Checks that only the boards which answered a wrong CRC are searched for
+        corrupted pages, so a silent board does not make the search time out.
+        """
+        self.check.return_value = (set([1]), set([3])) # board 2 is silent
+        self.find_corrupted.return_value = {3: 0x1000}
+
+        with patch('bootloader_flash.verification_failed') as failed:
+            main()
+            failed.assert_any_call(set([2, 3]))
+
+        self.find_corrupted.assert_any_call(self.conn, self.binary_data,
+                                            0x1000, set([3]))
+        self.print.assert_any_call('Node 3 has a corrupted page at 0x1000')
+
+    def test_no_page_search_if_no_board_answered(self):
+        self.check.return_value = (set([1]), set())
+
+        with patch('bootloader_flash.verification_failed'):
+            main()
+
+        self.assertFalse(self.find_corrupted.called)
+
     def test_do_not_run_by_default(self):
         """
         Checks that by default no run command are ran.
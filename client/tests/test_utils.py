@@ -1,12 +1,10 @@
 import unittest
-try:
-    from unittest.mock import *
-except ImportError:
-    from mock import *
+from unittest.mock import patch, Mock, ANY
 
 from utils import *
 from itertools import repeat
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import commands
 import msgpack
@@ -54,6 +52,12 @@ class WriteCommandTestCase(unittest.TestCase):
         for f in frames:
             fdesc.send_frame.assert_any_call(f)
 
+    def test_write_without_delay(self, sleep):
+        """
+        Checks that we don't wait after writing if no delay is requested.
+        """
+        write_command(Mock(), bytes(range(3)), [1], delay=0)
+        self.assertFalse(sleep.called)
 
 
 @patch('utils.read_can_datagrams')
@@ -64,7 +68,7 @@ class CommandRetryTestCase(unittest.TestCase):
         read.return_value = iter([(bytes(), [10], 1)])
 
         write_command_retry(port, bytes([1, 2, 3]), [1], source=10)
-        write.assert_any_call(port, bytes([1, 2, 3]), [1], 10)
+        write.assert_any_call(port, bytes([1, 2, 3]), [1], 10, delay=0)
 
     def test_return_dict(self, write, read):
         read.return_value = iter([(20, [10], 2), (10, [10], 1)])
@@ -80,8 +84,8 @@ class CommandRetryTestCase(unittest.TestCase):
             w.assert_any_call(ANY)
 
         # Check that we retrued for the board who timed out
-        write.assert_any_call(None, data, [1, 2], 0)
-        write.assert_any_call(None, data, [1], 0)
+        write.assert_any_call(None, data, [1, 2], 0, delay=0)
+        write.assert_any_call(None, data, [1], 0, delay=0)
 
     def test_retry_limit(self, write, read):
         """
@@ -100,6 +104,30 @@ class CommandRetryTestCase(unittest.TestCase):
             critical.assert_any_call(ANY)
 
 
+class PrefetchTestCase(unittest.TestCase):
+    def test_without_executor(self):
+        res = prefetch(lambda x: 2 * x, range(4))
+        self.assertEqual([0, 2, 4, 6], list(res))
+
+    def test_with_executor(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            res = prefetch(lambda x: 2 * x, range(4), executor)
+            self.assertEqual([0, 2, 4, 6], list(res))
+
+    def test_computes_next_item_ahead(self):
+        """
+        Checks that the next item is submitted before the current one is
+        returned.
+        """
+        executor = Mock()
+        executor.submit.side_effect = lambda f, x: Mock(**{'result.return_value': f(x)})
+
+        res = prefetch(lambda x: x, range(3), executor)
+
+        self.assertEqual(0, next(res))
+        self.assertEqual(2, executor.submit.call_count)
+
+
 class OpenConnectionTestCase(unittest.TestCase):
     Args = namedtuple("Args", ["serial_device", "can_interface"])
 
@@ -119,9 +119,11 @@ def ping_board(fdesc, destination):
     return True
 
 
-def write_command(fdesc, command, destinations, source=0):
+def write_command(fdesc, command, destinations, source=0, delay=0.1):
     """
     Writes the given encoded command to the CAN bridge.
+
+    Waits for delay seconds afterwards to let the boards process the command.
     """
     datagram = can.encode_datagram(command, destinations)
     frames = can.datagram_to_frames(datagram, source)
@@ -129,15 +131,19 @@ def write_command(fdesc, command, destinations, source=0):
     for frame in frames:
         fdesc.send_frame(frame)
 
-    time.sleep(0.1)
+    if delay:
+        time.sleep(delay)
 
 
 def write_command_retry(fdesc, command, destinations, source=0, retry_limit=3):
     """
     Writes a command, retries as long as there is no answer and returns a dictionnary containing
     a map of each board ID and its answer.
+
+    As we block until the boards answer, there is no need to wait after
+    sending the command, which would leave the bus idle for every command.
     """
-    write_command(fdesc, command, destinations, source)
+    write_command(fdesc, command, destinations, source, delay=0)
     reader = read_can_datagrams(fdesc)
     answers = dict()
 
@@ -153,7 +159,7 @@ def write_command_retry(fdesc, command, destinations, source=0, retry_limit=3):
                 raise IOError
 
             timedout_boards = list(set(destinations) - set(answers))
-            write_command(fdesc, command, timedout_boards, source)
+            write_command(fdesc, command, timedout_boards, source, delay=0)
             msg = "The following boards did not answer: {}, retrying..".format(
                 " ".join(str(t) for t in timedout_boards))
 
@@ -179,3 +185,29 @@ def config_update_and_save(fdesc, config, destinations):
 
     # Then save the config to flash
     write_command_retry(fdesc, commands.encode_save_config(), destinations)
+
+
+def prefetch(function, iterable, executor=None):
+    """
+    Yields function(item) for each item of the iterable.
+
+    If an executor is given, the next result is computed by it while the
+    caller is still processing the current one.
+    """
+    if executor is None:
+        for item in iterable:
+            yield function(item)
+        return
+
+    future = None
+
+    for item in iterable:
+        next_future = executor.submit(function, item)
+
+        if future is not None:
+            yield future.result()
+
+        future = next_future
+
+    if future is not None:
+        yield future.result()